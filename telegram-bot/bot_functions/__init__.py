@@ -1 +1 @@
-from .main import (Bot)
\ No newline at end of file
+from .main import (Bot, PARSE_MODE_HTML, PARSE_MODE_MD)
\ No newline at end of file
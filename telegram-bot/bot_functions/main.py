@@ -1,136 +1,340 @@
+import copy
+import functools
 import requests
-import json
-from collections import namedtuple
-from typing import Callable, Tuple
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Union
 import os
+import threading
+import time
+
+PARSE_MODE_HTML = "HTML"
+PARSE_MODE_MD = "MarkdownV2"
+
+# update types carrying a message-like payload, most frequent first
+_UPDATE_KEYS = (
+    "message",
+    "callback_query",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+)
 
 
 class Bot:
+    # private names are mangled here the same way as in the methods
+    __slots__ = (
+        "__bot_token",
+        "__base_url",
+        "_session",
+        "_url_webhook",
+        "_url_send",
+        "_url_edit",
+        "_url_delete",
+        "_url_get_me",
+        "_url_get_chat",
+        "_url_get_webhook_info",
+        "_cache",
+        "_cache_lock",
+        "_cache_generation",
+        "_commands",
+    )
     BOT_TOKEN = os.environ.get("TG_BOT_TOKEN")
-    PARSE_MODES = namedtuple(
-        "Parse_Modes", ("HTML", "MD"))(
-        "HTML", "MarkdownV2")
+    # point this at a local `telegram-bot-api` server to skip the round-trip
+    # to api.telegram.org, e.g. TG_API_ROOT=http://127.0.0.1:8081
+    API_ROOT = os.environ.get("TG_API_ROOT", "https://api.telegram.org")
+    REQUEST_TIMEOUT = 10
+    # send_many: in-flight requests (within the session pool size) and
+    # sends started per second (below telegram's ~30 messages/sec limit)
+    MAX_PARALLEL_SENDS = 25
+    MESSAGES_PER_SECOND = 25
+    # responses of read-only methods (getMe, getChat, getWebhookInfo)
+    CACHE_TTL = 3600
+    CACHE_MAXSIZE = 128
 
-    def __init__(self, token: str = BOT_TOKEN) -> None:
+    def __init__(
+        self,
+        token: str = BOT_TOKEN,
+        session: requests.Session = None,
+        api_root: str = API_ROOT,
+    ) -> None:
         """
-        arguments: token - string (required if enviornment variable 'TG_BOT_TOKEN' is not set)
+        arguments:
+            token - string (required if enviornment variable 'TG_BOT_TOKEN' is not set)
+            session - requests.Session (optional, to share one connection pool)
+            api_root - string (optional, defaults to enviornment variable 'TG_API_ROOT' or https://api.telegram.org)
         returns: None
         """
         self.__bot_token = token
-        self.__base_url = f"https://api.telegram.org/bot{token}"
+        self.__base_url = f"{api_root.rstrip('/')}/bot{token}"
+        self._url_webhook = f"{self.__base_url}/setWebhook"
+        self._url_send = f"{self.__base_url}/sendMessage"
+        self._url_edit = f"{self.__base_url}/editMessageText"
+        self._url_delete = f"{self.__base_url}/deleteMessage"
+        self._url_get_me = f"{self.__base_url}/getMe"
+        self._url_get_chat = f"{self.__base_url}/getChat"
+        self._url_get_webhook_info = f"{self.__base_url}/getWebhookInfo"
+        # (url, sorted params) -> (expiry time, response)
+        self._cache = {}
+        # shared by the threads of the web server and send_many
+        self._cache_lock = threading.Lock()
+        # bumped by writes, a response fetched before a write isn't cached
+        self._cache_generation = 0
+        # command name (without "/") -> handler(chat)
+        self._commands = {}
+        if session is None:
+            # keep-alive pool so every api call reuses the same TLS connection
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50)
+            # http:// too, a local bot api server is usually plain http
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self._session = session
+
+    def close(self) -> None:
+        """
+        Close the underlying http session (call it once on shutdown).
+        """
+        self._session.close()
+
+    def _call(self, url: str, data: dict = None, cacheable: bool = False) -> dict:
+        """
+        Post `data` to an api endpoint and return the decoded response.
+        Successful responses of cacheable calls are reused for CACHE_TTL seconds,
+        every caller gets its own copy.
+        """
+        if not cacheable:
+            return self._session.post(
+                url, json=data, timeout=self.REQUEST_TIMEOUT).json()
+        key = (url, tuple(sorted(data.items())) if data else ())
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                return copy.deepcopy(cached[1])
+            generation = self._cache_generation
+        result = self._session.post(
+            url, json=data, timeout=self.REQUEST_TIMEOUT).json()
+        if result.get("ok"):
+            with self._cache_lock:
+                if generation != self._cache_generation:
+                    return result
+                now = time.monotonic()
+                if len(self._cache) >= self.CACHE_MAXSIZE:
+                    # drop expired entries first, then the oldest live one
+                    for old_key in [
+                        k for k, (expires, _) in self._cache.items()
+                        if expires <= now
+                    ]:
+                        del self._cache[old_key]
+                    if len(self._cache) >= self.CACHE_MAXSIZE:
+                        del self._cache[next(iter(self._cache))]
+                self._cache[key] = (now + self.CACHE_TTL, result)
+            result = copy.deepcopy(result)
+        return result
 
     # this function will handle the webhook url setting.
-    def set_webhook(self, webhook_url: str) -> dict:
-        request_url = self.__base_url + "/setWebhook"
+    def set_webhook(self, webhook_url: str, allowed_updates: list = None) -> dict:
+        """
+        arguments:
+            webhook_url - string
+            allowed_updates - list of update types telegram should send (all by default)
+        """
         data = {"url": webhook_url}
-        return requests.post(request_url, json=data).json()
+        if allowed_updates is not None:
+            data["allowed_updates"] = allowed_updates
+        result = self._call(self._url_webhook, data)
+        # cached getWebhookInfo (and friends) are stale after a write
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._cache.clear()
+        return result
+
+    def get_webhook_info(self) -> dict:
+        return self._call(self._url_get_webhook_info, cacheable=True)
+
+    def get_me(self) -> dict:
+        return self._call(self._url_get_me, cacheable=True)
+
+    def get_chat(self, chat_id: int) -> dict:
+        return self._call(self._url_get_chat, {"chat_id": chat_id}, cacheable=True)
 
     def validate_update(self, update: dict) -> "UpdateChat":
-        return UpdateChat(update, self.__bot_token)
+        return UpdateChat(update, self)
+
+    def command_handler(self, command: str, handler: Callable) -> None:
+        """
+        Register `handler(chat)` to be called for `/command` by dispatch_command.
+        Usage:
+            bot.command_handler("start", start_handler)
+        """
+        self._commands[command] = handler
+
+    def dispatch_command(self, chat: "UpdateChat") -> bool:
+        """
+        Call the handler registered for the command in `chat`.
+        Returns `True` if a handler was found, `False` otherwise.
+        """
+        command = chat.get_command()
+        handler = self._commands.get(command) if command else None
+        if handler is None:
+            return False
+        handler(chat)
+        return True
 
     def send_message(
         self,
         chat_id: int,
         text: str,
         message_thread_id: int = None,
-        parse_mode: str = "HTML",
-        entities: dict = {},
+        parse_mode: str = PARSE_MODE_HTML,
+        entities: list = None,
         disable_web_page_preview: bool = False,
         disable_notification: bool = False,
         protect_content: bool = False,
         reply_to_message_id: int = None,
         allow_sending_without_reply: bool = False,
-        reply_markup: dict = {},
+        reply_markup: dict = None,
     ) -> dict:
         """
         Please refer to this link for more information on arguments:\n
         https://core.telegram.org/bots/api#sendmessage\n
         Returns a new object with methods to update message text or delete the sent message.
         """
-        url = f"{self.__base_url}/sendMessage"
-        data = {
-            "chat_id": chat_id,
-            "parse_mode": parse_mode if parse_mode is not None else self.PARSE_MODES.HTML,
-            "text": text,
-            "allow_sending_without_reply": True,
+        optional = {
+            "parse_mode": parse_mode,
+            "message_thread_id": message_thread_id,
+            "entities": entities,
             "disable_web_page_preview": disable_web_page_preview,
-            "reply_to_message_id": reply_to_message_id,
-            "allow_sending_without_reply": allow_sending_without_reply,
-            "reply_markup": json.dumps(reply_markup),
             "disable_notification": disable_notification,
             "protect_content": protect_content,
-            "message_thread_id": message_thread_id,
-            "entities": json.dumps(entities),
+            "reply_to_message_id": reply_to_message_id,
+            "allow_sending_without_reply": allow_sending_without_reply,
+            "reply_markup": reply_markup,
         }
-        return SentChat(self.__bot_token, requests.post(url, json=data).json())
+        # fields that are unset/False/empty match telegram's defaults, leave
+        # them out. the request body is already json, so nested objects need
+        # no extra json.dumps pass
+        data = {"chat_id": chat_id, "text": text}
+        data.update((key, value) for key, value in optional.items() if value)
+        return SentChat(self, self._call(self._url_send, data))
+
+    def send_many(
+        self, items: List[Tuple[int, str]]
+    ) -> List[Union["SentChat", Exception]]:
+        """
+        Send many messages concurrently over the shared session, starting at
+        most MESSAGES_PER_SECOND sends per second.
+        arguments: items - list of (chat_id, text) tuples
+        returns: list, in the same order as items, holding the SentChat of each
+            send or the exception it raised (a failed send doesn't stop the rest)
+        """
+        if not items:
+            return []
+        interval = 1 / self.MESSAGES_PER_SECOND
+        workers = min(self.MAX_PARALLEL_SENDS, len(items))
+        futures = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            next_start = time.monotonic()
+            for chat_id, text in items:
+                delay = next_start - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_start += interval
+                futures.append(
+                    executor.submit(self.send_message, chat_id, text))
+        results = []
+        for future in futures:
+            error = future.exception()
+            results.append(future.result() if error is None else error)
+        return results
 
     def edit_message_text(self, chat_id: int, message_id: int, text: str):
-        url = self.__base_url + "/editMessageText"
         payload = {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": text,
-            "parse_mode": "HTML",
+            "parse_mode": PARSE_MODE_HTML,
         }
-        return requests.post(url, json=payload).json()
+        return self._call(self._url_edit, payload)
 
     def delete_message(self, chat_id: int, message_id: int):
-        url = self.__base_url + "/deleteMessage"
         payload = {"chat_id": chat_id, "message_id": message_id}
-        return requests.post(url, json=payload).json()
+        return self._call(self._url_delete, payload)
 
+    # buttons are cached, the same dict is returned for the same arguments
+    # so treat it as read-only
     @staticmethod
+    @functools.lru_cache(maxsize=256)
     def callback_button(text: str, callback_data: str = None) -> dict:
         return {"text": text, "callback_data": callback_data}
 
     @staticmethod
+    @functools.lru_cache(maxsize=256)
     def url_button(text: str, url: str = None) -> dict:
         return {"text": text, "url": url}
 
 
-class UpdateChat(Bot):
-    def __init__(self, update: dict, token: str) -> None:
+class UpdateChat:
+    """
+    Lightweight view of an incoming update, bound to the bot that received it.
+    """
+
+    __slots__ = (
+        "_bot",
+        "update_type",
+        "from_id",
+        "text",
+        "chat_id",
+        "message_id",
+        "__message_type",
+        "__entities",
+    )
+
+    def __init__(self, update: dict, bot: Bot) -> None:
         """
         Arguments:
             update - dict,
-            token - str
+            bot - Bot (used to answer the update)
         Returns:
             None
         """
-        super().__init__(token)
-        update_tuple = tuple(update.items())
-        self.update_type = update_tuple[1][0]
-        self.from_id = update_tuple[1][1].get("from", {}).get("id")
-        self.text = update_tuple[1][1].get("text")
-        self.__message_type = (
-            update_tuple[1][1].get("entities", [{}])[0].get("type", "text")
-        )
-        self.__entities = update_tuple[1][1].get("entities", [{}])
+        self._bot = bot
+        for update_type in _UPDATE_KEYS:
+            if update_type in update:
+                break
+        else:
+            # any other update type, the payload is the key next to update_id
+            update_type = next(
+                (key for key in update if key != "update_id"), None)
+        self.update_type = update_type
+        payload = update.get(update_type, {})
+        self.from_id = payload.get("from", {}).get("id")
+        self.text = payload.get("text")
+        self.__entities = payload.get("entities", [{}])
+        self.__message_type = self.__entities[0].get("type", "text")
         if self.update_type == "callback_query":
-            self.chat_id: int = update_tuple[1][1]["message"].get(
-                "chat", {}).get("id")
-            self.message_id: int = update_tuple[1][1]["message"].get(
-                "message_id")
+            self.chat_id: int = payload["message"].get("chat", {}).get("id")
+            self.message_id: int = payload["message"].get("message_id")
         else:
-            self.chat_id = update_tuple[1][1].get("chat", {}).get("id")
-            self.message_id = update_tuple[1][1].get("message_id")
+            self.chat_id = payload.get("chat", {}).get("id")
+            self.message_id = payload.get("message_id")
 
     def send_message(self, text: str) -> dict:
-        return super().send_message(self.chat_id, text)
+        return self._bot.send_message(self.chat_id, text)
 
-    def send_inline_keyboard(self, text: str, reply_markup={}) -> dict:
-        return super().send_message(self.chat_id, text, reply_markup=reply_markup)
+    def send_inline_keyboard(self, text: str, reply_markup: dict = None) -> dict:
+        return self._bot.send_message(self.chat_id, text, reply_markup=reply_markup)
 
     def reply_message(self, text: str) -> dict:
-        return super().send_message(
+        return self._bot.send_message(
             self.from_id, text, reply_to_message_id=self.message_id
         )
 
-    def command_handler(self, command: str, handler: Callable):
+    def command_handler(self, command: str, handler: Callable) -> None:
         """
-        I'll work on this later, It will add a command handler to the class.
+        Register a command handler on the bot this chat belongs to.
         """
-        pass
+        self._bot.command_handler(command, handler)
 
     def get_command(
         self, argument: bool = False, only_start: bool = True
@@ -148,8 +352,9 @@ class UpdateChat(Bot):
         """
         if self.message_type != "bot_command":
             return None
-        start = self.__entities[0]["offset"] + 1
-        end = start + self.__entities[0]["length"] - 1
+        entity = self.__entities[0]
+        start = entity["offset"] + 1
+        end = start + entity["length"] - 1
         if only_start:
             if start == 1:
                 if not argument:
@@ -169,15 +374,23 @@ class UpdateChat(Bot):
         return self.__message_type
 
 
-class SentChat(Bot):
-    def __init__(self, token: str, sent_msg: dict) -> None:
-        super().__init__(token)
-        update_tuple = tuple(sent_msg.items())
-        self.update_type = update_tuple[1][0]
-        self.from_id = update_tuple[1][1].get("from", {}).get("id")
-        self.chat_id = update_tuple[1][1].get("chat", {}).get("id")
-        self.message_id = update_tuple[1][1].get("message_id")
-        self.sent_text = update_tuple[1][1].get("message_id")
+class SentChat:
+    """
+    Lightweight view of a sent message, bound to the bot that sent it.
+    """
+
+    __slots__ = (
+        "_bot", "update_type", "from_id", "chat_id", "message_id", "sent_text")
+
+    def __init__(self, bot: Bot, sent_msg: dict) -> None:
+        self._bot = bot
+        # api responses look like {"ok": true, "result": {...message...}}
+        result = sent_msg.get("result", {})
+        self.update_type = "result" if "result" in sent_msg else None
+        self.from_id = result.get("from", {}).get("id")
+        self.chat_id = result.get("chat", {}).get("id")
+        self.message_id = result.get("message_id")
+        self.sent_text = result.get("text")
 
     def edit_message_text(self, text: str):
         """
@@ -186,7 +399,7 @@ class SentChat(Bot):
             message = bot.send_message(chat_id, text)
             message.edit_message_text(new_text)
         """
-        return super().edit_message_text(self.chat_id, self.message_id, text)
+        return self._bot.edit_message_text(self.chat_id, self.message_id, text)
 
     def delete_message(self):
         """
@@ -195,4 +408,4 @@ class SentChat(Bot):
             message = bot.send_message(chat_id, text)
             message.delete_message()
         """
-        return super().delete_message(self.chat_id, self.message_id)
+        return self._bot.delete_message(self.chat_id, self.message_id)
@@ -1,5 +1,6 @@
 # imports
 import os
+import orjson
 from flask import Flask, request, Response
 from bot_functions import Bot
 from messages import replies
@@ -19,50 +20,74 @@ DB_URL = ""
 # eg https://01jt23tc-8443.asse.devtunnels.ms/
 WEBHOOK_URL = ""
 
+# flask debugger and reloader, for local development only (TG_BOT_DEBUG=1)
+DEBUG = os.environ.get("TG_BOT_DEBUG") == "1"
+
+# inline keyboard for the /select command, it never changes so build it once
+SELECT_KEYBOARD = {
+    "inline_keyboard": [
+        [Bot.callback_button("Foundation", "1")],
+        [
+            Bot.callback_button("Diploma Programming", "2"),
+            Bot.callback_button("Diploma DS", "3"),
+        ],
+        [Bot.callback_button("Degree", "4")],
+    ]
+}
+
 bot = Bot(BOT_TOKEN)
 users_db = UsersDBHandler(DB_URL, "foundation", "users")
 notes_db = MongoDBNotes(DB_URL, "NOTES", "NOTES")
 pyq_db = MongoDBPYQ(DB_URL, "PYQ", "PYQ")
-bot.set_webhook(WEBHOOK_URL)
+# only ask telegram for the update types in UPDATE_HANDLERS below
+bot.set_webhook(WEBHOOK_URL, allowed_updates=["message"])
 app = Flask(__name__)
 
 
+def start_command(chat):
+    print("user sent start command")
+    # register_user
+    if users_db.user_exists(str(chat.chat_id)):
+        print("user is old")
+        chat.send_message(replies.get("/start_old_user"))
+    else:
+        print("user is new")
+        users_db.add_chat_id(str(chat.chat_id))
+        chat.send_message(replies.get("/start_new_user"))
+
+
+def select_command(chat):
+    chat.send_inline_keyboard(replies.get("/select"), SELECT_KEYBOARD)
+
+
+bot.command_handler("start", start_command)
+bot.command_handler("select", select_command)
+
+
+# update type -> handler(chat), update types without a handler are ignored
+UPDATE_HANDLERS = {
+    "message": bot.dispatch_command,
+}
+
+
 @app.route("/", methods=["POST", "GET"])
 def index():
     if request.method == "POST":
-        response_ = request.get_json()
+        try:
+            response_ = orjson.loads(request.get_data())
+        except orjson.JSONDecodeError:
+            return Response("bad request", status=400)
         chat = bot.validate_update(response_)
-        if chat.message_type == "bot_command":
-            command = chat.get_command(argument=True)
-            if command[0] == "start":
-                print("user sent start command")
-                # register_user
-                if users_db.user_exists(
-                        str(response_["message"]["chat"]["id"])):
-                    print("user is old")
-                    chat.send_message(replies.get("/start_old_user"))
-                else:
-                    print("user is new")
-                    users_db.add_chat_id(
-                        str(response_["message"]["chat"]["id"]))
-                    chat.send_message(replies.get("/start_new_user"))
-            elif command[0] == "select":
-                keyboard = {
-                    "inline_keyboard": [
-                        [bot.callback_button("Foundation", "1")],
-                        [
-                            bot.callback_button("Diploma Programming", "2"),
-                            bot.callback_button("Diploma DS", "3"),
-                        ],
-                        [bot.callback_button("Degree", "4")],
-                    ]
-                }
-                chat.send_inline_keyboard(replies.get("/select"), keyboard)
+        handler = UPDATE_HANDLERS.get(chat.update_type)
+        if handler is not None:
+            handler(chat)
         return Response("ok", status=200)
     else:
         return "Bot is active now"
 
 
 if __name__ == "__main__":
-    app.run(port=8443, debug=True, use_reloader=True)
+    # one thread per update, a slow handler doesn't hold up other users
+    app.run(port=8443, debug=DEBUG, use_reloader=DEBUG, threaded=True)
     users_db.close_connection()
+    bot.close()